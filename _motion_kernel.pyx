@@ -0,0 +1,60 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+"""
+Compiled motion detection kernels, build with: python3 setup.py build_ext --inplace
+
+The loops release the GIL, so frame capture can run while a frame is compared.
+"""
+
+from libc.stdlib cimport abs
+
+
+cpdef double histogram_difference(const unsigned char[:, ::1] frame, const long long[::1] previous_hist,
+                                  long long[::1] hist, Py_ssize_t step):
+    """
+    Builds the histogram of every step-th pixel of a luma frame into hist and compares it with the previous one.
+
+    :param frame: 2D uint8 luma plane
+    :param previous_hist: 256 bin int64 histogram of the previous frame
+    :param hist: 256 bin int64 output histogram
+    :param step: subsample step in both directions
+    :return: mean absolute histogram difference
+    """
+    cdef Py_ssize_t y, x, i
+    cdef Py_ssize_t rows = (frame.shape[0] + step - 1) // step
+    cdef Py_ssize_t cols = (frame.shape[1] + step - 1) // step
+    cdef long long total = 0
+    cdef long long delta
+
+    with nogil:
+        for i in range(256):
+            hist[i] = 0
+        for y in range(rows):
+            for x in range(cols):
+                hist[frame[y * step, x * step]] += 1
+
+        for i in range(256):
+            delta = hist[i] - previous_hist[i]
+            total += delta if delta >= 0 else -delta
+    return total / 256.0
+
+
+cpdef double frame_sad(const unsigned char[:, ::1] frame, const unsigned char[:, ::1] previous_frame,
+                       Py_ssize_t step):
+    """
+    Calculates the mean absolute pixel difference of every step-th pixel of two luma frames.
+
+    :param frame: 2D uint8 luma plane
+    :param previous_frame: 2D uint8 luma plane of the previous frame
+    :param step: subsample step in both directions
+    :return: mean absolute pixel difference
+    """
+    cdef Py_ssize_t y, x
+    cdef Py_ssize_t rows = (frame.shape[0] + step - 1) // step
+    cdef Py_ssize_t cols = (frame.shape[1] + step - 1) // step
+    cdef long long total = 0
+
+    with nogil:
+        for y in range(rows):
+            for x in range(cols):
+                total += abs(<int> frame[y * step, x * step] - <int> previous_frame[y * step, x * step])
+    return total / <double> (rows * cols)
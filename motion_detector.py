@@ -1,23 +1,27 @@
 #!/usr/bin/python3
 import argparse
+import inspect
+import base64
+import concurrent.futures
 import datetime
 import time
 import logging
 import os
+import queue
 import signal
 import smtplib
 import socket
 import sys
-from email import encoders
-from email.mime.base import MIMEBase
-from email.mime.multipart import MIMEMultipart
+import threading
+import uuid
 
 import colorama
-from PIL import Image
+import numpy as np
 from picamera2 import Picamera2, Preview
 from picamera2.encoders import H264Encoder
 from picamera2.outputs import CircularOutput
 from picamera2.controls import Controls
+from picamera2.request import _MappedBuffer
 
 from colorama import init as colorama_init, Back
 from colorama import Fore
@@ -25,10 +29,119 @@ from colorama import Style
 
 from collections import deque
 
+try:
+    import _motion_kernel
+except ImportError:
+    _motion_kernel = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
 # setLevel(logging.WARNING) seems to have no impact
 logging.getLogger("picamera2").disabled = True
 
 
+def calculate_histogram_difference(frame, previous_hist, step):
+    """
+    Builds the histogram of every step-th pixel of a luma frame and compares it with the previous one.
+
+    :param frame: 2D uint8 luma plane
+    :param previous_hist: 256 bin int64 histogram of the previous frame
+    :param step: subsample step in both directions
+    :return: mean absolute histogram difference and the new histogram
+    """
+    hist = np.bincount(frame[::step, ::step].ravel(), minlength=256)
+    return np.abs(hist - previous_hist).mean(), hist
+
+
+def calculate_frame_sad(frame, previous_frame, step):
+    """
+    Calculates the mean absolute pixel difference of every step-th pixel of two luma frames.
+
+    :param frame: 2D uint8 luma plane
+    :param previous_frame: 2D uint8 luma plane of the previous frame
+    :param step: subsample step in both directions
+    :return: mean absolute pixel difference
+    """
+    current = frame[::step, ::step].astype(np.int16)
+    return np.abs(current - previous_frame[::step, ::step]).mean()
+
+
+if _motion_kernel is not None:
+    def calculate_histogram_difference(frame, previous_hist, step):
+        hist = np.empty(256, np.int64)
+        return _motion_kernel.histogram_difference(frame, previous_hist, hist, step), hist
+
+    calculate_frame_sad = _motion_kernel.frame_sad
+elif numba is not None:
+    @numba.njit(cache=True, parallel=True)
+    def _numba_histogram_difference(frame, previous_hist, step, chunks):
+        rows = (frame.shape[0] + step - 1) // step
+        partial_hists = np.zeros((chunks, 256), np.int64)
+        for chunk in numba.prange(chunks):
+            for r in range(chunk, rows, chunks):
+                row = frame[r * step]
+                for x in range(0, frame.shape[1], step):
+                    partial_hists[chunk, row[x]] += 1
+        hist = partial_hists.sum(axis=0)
+        return np.abs(hist - previous_hist).mean(), hist
+
+    # read outside of the kernel, a call to get_num_threads() inside it prevents caching
+    _NUMBA_CHUNKS = numba.get_num_threads()
+
+    def calculate_histogram_difference(frame, previous_hist, step):
+        return _numba_histogram_difference(frame, previous_hist, step, _NUMBA_CHUNKS)
+
+    @numba.njit(cache=True, parallel=True)
+    def calculate_frame_sad(frame, previous_frame, step):
+        rows = (frame.shape[0] + step - 1) // step
+        cols = (frame.shape[1] + step - 1) // step
+        row_sums = np.zeros(rows, np.int64)
+        for r in numba.prange(rows):
+            current_row = frame[r * step]
+            previous_row = previous_frame[r * step]
+            total = 0
+            for x in range(0, frame.shape[1], step):
+                total += abs(np.int32(current_row[x]) - np.int32(previous_row[x]))
+            row_sums[r] = total
+        return row_sums.sum() / (rows * cols)
+
+
+# older picamera2 releases map buffers without the allocator and take no write argument
+LUMA_PLANE_MAPPING_SUPPORTED = 'write' in inspect.signature(_MappedBuffer.__init__).parameters
+
+
+class MappedLumaPlane(_MappedBuffer):
+    """Maps a YUV420 buffer through picamera2 but only exposes its Y plane."""
+
+    def __init__(self, request, stream):
+        """MappedLumaPlane
+
+        :param request: completed request holding the buffer
+        :param stream: name of the YUV420 stream
+        """
+        super().__init__(request, stream, write=False)
+        if isinstance(stream, str):
+            stream = request.stream_map[stream]
+        self.__fb = request.request.buffers[stream]
+        self.__plane = None
+
+    def __enter__(self):
+        # the allocator syncs the buffer for CPU access and caches the mapping
+        buffer = super().__enter__()
+        offset = self.__fb.planes[0].offset
+        self.__plane = memoryview(buffer)[offset:offset + self.__fb.metadata.planes[0].bytes_used]
+        return self.__plane
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if self.__plane is not None:
+            self.__plane.release()
+            self.__plane = None
+        return super().__exit__(exc_type, exc_value, exc_traceback)
+
+
 def command_line_handler(signum, frame):
     res = input("Ctrl-C was pressed. Do you really want to exit? y/n ")
     if res == 'y':
@@ -67,6 +180,9 @@ def parse_command_line_arguments():
     parser.add_argument('--min-pixel-diff', type=float, default=7.2,
                         help='Minimum number of pixel changes to detect motion (determined with numpy by calculating the mean of the squared pixel difference between two frames)',
                         required=False)
+    parser.add_argument('--diff-method', choices=['histogram', 'sad'], default='histogram',
+                        help='Frame comparison: mean absolute histogram difference or mean absolute pixel difference (sad)',
+                        required=False)
     parser.add_argument('--capture-lores', help='enables capture of lores buffer', action='store_true')
     parser.add_argument('--recording-dir', default='./recordings/', help='directory to store recordings',
                         required=False)
@@ -97,6 +213,19 @@ def parse_command_line_arguments():
 class MotionDetector:
     """This class contains the main logic for motion detection."""
     __MAX_TIME_SINCE_LAST_MOTION_DETECTION_SECONDS = 5.0
+    __SUBSAMPLE_STEP = 2
+    __MOTION_HOLD_SECONDS = 2.0
+    __ERROR_DELAY_SECONDS = 0.05
+
+    __DEBUG_PREFIX = f"{Fore.LIGHTBLUE_EX} "
+    __INFO_PREFIX = f"{Fore.LIGHTYELLOW_EX} "
+    __WARNING_PREFIX = f"{Fore.YELLOW} "
+    __ERROR_PREFIX = f"{Fore.RED} "
+    __STATS_PREFIX = f"{Fore.LIGHTBLUE_EX} "
+    __EVENTS_PREFIX = f"{Fore.LIGHTCYAN_EX} "
+    __MOVEMENT_START_PREFIX = f"{Back.RED} "
+    __MOVEMENT_END_PREFIX = f"{Back.GREEN}{Fore.BLACK} "
+    __LOG_SUFFIX = f" {Style.RESET_ALL}"
 
     def __init__(self, args: argparse.Namespace):
         """MotionDetector
@@ -107,26 +236,35 @@ class MotionDetector:
         self.__encoder = None
         self.__encoding = False
         self.__start_time_of_last_recording = None
+        self.__recording_started_at = None
         self.__time_of_last_motion_detection = None
         self.__display_interval = 100
         self.__events_interval = 1000
         self.__tick = 0
         self.__events_tick = 0
 
-        self.__diff_history = deque()
         self.__diff_history_count = 1000
-        self.__diff_min = 9999
+        self.__diff_history = np.zeros(self.__diff_history_count, dtype=np.float32)
+        self.__diff_index = 0
+        self.__diff_min = 0
         self.__diff_max = 0
         self.__diff_average = 0
 
         self.__motion_events = deque()
 
+        self.__previous_hist = None
+        self.__empty_hist = np.zeros(256, np.int64)
+        self.__previous_frame = None
+        self.__previous_diff = 0.0
+        self.__frames = queue.Queue(maxsize=1)
+
         self.__zoom_factor = args.zoom
         self.__lores_width = args.lores_width
         self.__lores_height = args.lores_height
         self.__width = args.width
         self.__height = args.height
         self.__min_pixel_diff = args.min_pixel_diff
+        self.__diff_method = args.diff_method
         self.__capture_lores = args.capture_lores
         self.__gain = args.gain
         self.__exposure_time = args.exposure_time
@@ -145,6 +283,7 @@ class MotionDetector:
         self.__email_password = args.email_password
         self.__smtp_server = args.smtp_server
         self.__smtp_port = args.smtp_port
+        self.__uploader = concurrent.futures.ThreadPoolExecutor(max_workers=2)
 
         self.__set_up_camera(args.preview)
 
@@ -166,72 +305,204 @@ class MotionDetector:
 
         self.__set_zoom_factor()
 
+        # compile the kernel before the first frame arrives
+        if self.__diff_method == 'sad':
+            calculate_frame_sad(np.zeros((2, 2), np.uint8), np.zeros((2, 2), np.uint8), 1)
+        else:
+            calculate_histogram_difference(np.zeros((2, 2), np.uint8), np.zeros(256, np.int64), 1)
+
         self.__loop()
 
     def __loop(self):
         """
         Runs the actual motion detection loop that, optionally, triggers sends the recording via email.
         """
+        threading.Thread(target=self.__capture_loop, daemon=True).start()
+
+        while True:
+            current_frame = self.__frames.get()
+            if isinstance(current_frame, Exception):
+                # the capture thread has stopped, no further frames will arrive
+                raise current_frame
+            now = time.monotonic()
+            if self.__is_within_motion_hold(now):
+                # the recording continues anyway, the frame difference would be ignored
+                self.__reset_frame_difference()
+                hist_diff = None
+            else:
+                hist_diff = self.__calculate_frame_difference(current_frame)
+            motion_detected = False
+            if hist_diff is not None:
+                self.store_diff_history(hist_diff)
+                # two consecutive diffs (three frames) must exceed the threshold, so a single diff spike such as a
+                # step change in lighting is ignored. A single outlier frame still produces two large diffs.
+                motion_detected = hist_diff > self.__min_pixel_diff and self.__previous_diff > self.__min_pixel_diff
+                self.__previous_diff = hist_diff
+            if self.__is_max_recording_length_exceeded(now):
+                self.log_info(
+                    "Max recording time exceeded after %s seconds", now - self.__recording_started_at)
+                self.__run_recording_io(self.__write_recording_to_file)
+            elif motion_detected and not self.__encoding:
+                if not self.__no_save:
+                    self.__start_time_of_last_recording = datetime.datetime.now()
+                    self.__recording_started_at = now
+                    self.log_info("Starting new recording: %s", self.__start_time_of_last_recording)
+                    if not self.__run_recording_io(self.__start_recording):
+                        self.__start_time_of_last_recording = None
+                        self.__recording_started_at = None
+                        continue
+                else:
+                    self.__encoding = True
+                self.__time_of_last_motion_detection = now
+                self.log_movement_start("Motion Detected - Diff: %s", hist_diff)
+                self.__motion_events.appendleft(time.time())
+            elif self.__is_max_time_since_last_motion_detection_exceeded(now):
+                if not self.__no_save:
+                    self.log_info("Max time since last motion detection exceeded")
+                    self.__run_recording_io(self.__write_recording_to_file)
+                else:
+                    self.__encoding = False
+                    self.log_movement_end("Motion No-Longer Detected - Diff: %s", hist_diff)
+
+    def __run_recording_io(self, action):
+        """
+        Runs a recording file operation, file errors are logged instead of stopping the motion detection.
+
+        :param action: operation to run
+        :return: True if the operation succeeded
+        """
+        try:
+            action()
+        except OSError as e:
+            self.log_error("An error occurred while writing the recording: %s", e)
+            time.sleep(self.__ERROR_DELAY_SECONDS)
+            return False
+        return True
+
+    def __capture_loop(self):
+        """
+        Captures frames on a separate thread so capturing overlaps with the motion detection.
+
+        Only the latest frame is kept, a frame that has not been picked up yet is replaced.
+        Unexpected errors are handed over to the motion detection loop, which raises them.
+        """
         w, h = self.__lsize
-        previous_frame = None
 
         while True:
             try:
-                current_frame = self.__picam2.capture_buffer("lores" if self.__capture_lores else "main")
-                current_frame = current_frame[:w * h].reshape(h, w)
-                if previous_frame is not None:
-                    hist_diff = self.__calculate_histogram_difference(current_frame, previous_frame)
-                    self.store_diff_history(hist_diff)
-                    if hist_diff > self.__min_pixel_diff and not self.__is_max_recording_length_exceeded() and not self.__encoding:
-                        if not self.__encoding:
-                            if not self.__no_save:
-                                self.__start_time_of_last_recording = datetime.datetime.now()
-                                self.log_info(f"Starting new recording: {self.__start_time_of_last_recording}")
-                                self.__start_recording()
-                            else:
-                                self.__encoding = True
-                        self.__time_of_last_motion_detection = datetime.datetime.now()
-                        self.log_movement_start(f"Motion Detected - Diff: {hist_diff}")
-                        self.__motion_events.appendleft(time.time())
-                    elif self.__is_max_recording_length_exceeded() and not self.__no_save:
-                        self.log_info(
-                            f"Max recording time exceeded after {(datetime.datetime.now() - self.__start_time_of_last_recording).total_seconds()} seconds")
-                        self.__write_recording_to_file()
-                    else:
-                        if self.__is_max_time_since_last_motion_detection_exceeded():
-                            if not self.__no_save:
-                                self.log_info("Max time since last motion detection exceeded")
-                                self.__write_recording_to_file()
-                            else:
-                                self.__encoding = False
-                                self.log_movement_end(f"Motion No-Longer Detected - Diff: {hist_diff}")
-
-                previous_frame = current_frame
-            except Exception as e:
-                self.log_error(f"An error occurred in the motion detection loop: {e}")
+                frame = self.__capture_frame(w, h)
+            except RuntimeError as e:
+                self.log_error("An error occurred while capturing a frame: %s", e)
+                time.sleep(self.__ERROR_DELAY_SECONDS)
                 continue
+            except Exception as e:
+                frame = e
+            try:
+                self.__frames.get_nowait()
+            except queue.Empty:
+                pass
+            self.__frames.put_nowait(frame)
+            if isinstance(frame, Exception):
+                return
+
+    def __capture_frame(self, w, h):
+        """
+        Captures the frame used for motion detection.
+
+        For the lores stream only the Y plane is mapped and copied, the chroma planes are never touched.
+        Older picamera2 releases fall back to copying the whole lores buffer.
+
+        :param w: frame width
+        :param h: frame height
+        :return: luma plane of the frame
+        """
+        if not self.__capture_lores:
+            raw = self.__picam2.capture_buffer("main")
+            frame = np.frombuffer(raw, dtype=np.uint8, count=w * h).reshape(h, w)
+            assert np.shares_memory(frame, raw), "frame must be a view of the captured buffer"
+            return frame
 
-    def __calculate_histogram_difference(self, current_frame, previous_frame):
-        current_image = Image.fromarray(current_frame)
-        previous_image = Image.fromarray(previous_frame)
+        if not LUMA_PLANE_MAPPING_SUPPORTED:
+            raw = self.__picam2.capture_buffer("lores")
+            return np.ascontiguousarray(raw[:self.__lores_stride * h].reshape(h, self.__lores_stride)[:, :w])
 
-        current_hist = current_image.histogram()
-        previous_hist = previous_image.histogram()
+        request = self.__picam2.capture_request()
+        try:
+            with MappedLumaPlane(request, "lores") as buffer:
+                # the only copy: the mapping is closed before the frame is handed to the motion detection thread
+                frame = np.frombuffer(buffer, dtype=np.uint8, count=self.__lores_stride * h)
+                frame = frame.reshape(h, self.__lores_stride)[:, :w].copy()
+        finally:
+            request.release()
+        return frame
+
+    def __is_within_motion_hold(self, now):
+        return self.__encoding and self.__time_of_last_motion_detection is not None and (
+                now - self.__time_of_last_motion_detection < self.__MOTION_HOLD_SECONDS)
+
+    def __reset_frame_difference(self):
+        """
+        Forgets the previous frame, so the next difference is not calculated against a stale frame.
+        """
+        self.__previous_hist = None
+        self.__previous_frame = None
+        self.__previous_diff = 0.0
 
-        hist_diff = sum([abs(c - p) for c, p in zip(current_hist, previous_hist)]) / len(current_hist)
+    def __calculate_frame_difference(self, current_frame):
+        """
+        Compares the current frame with the previous one using the configured diff method.
 
-        return hist_diff
+        :param current_frame: luma plane of the current frame
+        :return: difference or None for the first frame
+        """
+        if self.__diff_method == 'sad':
+            return self.__calculate_pixel_difference(current_frame)
+        return self.__calculate_histogram_difference(current_frame)
 
-    def __is_max_recording_length_exceeded(self):
-        return self.__max_recording_length_seconds > 0 and self.__start_time_of_last_recording is not None and (
-                (
-                        datetime.datetime.now() - self.__start_time_of_last_recording).total_seconds() >= self.__max_recording_length_seconds
-        )
+    def __calculate_pixel_difference(self, current_frame):
+        """
+        Compares the pixels of the current frame with the ones of the previous frame.
 
-    def __is_max_time_since_last_motion_detection_exceeded(self):
-        return self.__encoding and self.__time_of_last_motion_detection is not None and \
-            ((
-                     datetime.datetime.now() - self.__time_of_last_motion_detection).total_seconds() > self.__MAX_TIME_SINCE_LAST_MOTION_DETECTION_SECONDS)
+        Only every n-th pixel in both directions is compared, the mean is not affected by the subsampling.
+
+        :param current_frame: luma plane of the current frame
+        :return: mean absolute pixel difference or None for the first frame
+        """
+        previous_frame = self.__previous_frame
+        self.__previous_frame = current_frame
+
+        if previous_frame is None:
+            return None
+
+        return float(calculate_frame_sad(current_frame, previous_frame, self.__SUBSAMPLE_STEP))
+
+    def __calculate_histogram_difference(self, current_frame):
+        """
+        Compares the histogram of the current frame with the one of the previous frame.
+
+        Only every n-th pixel in both directions is counted, the difference is scaled back up so that
+        --min-pixel-diff keeps its meaning.
+
+        :param current_frame: luma plane of the current frame
+        :return: mean absolute histogram difference or None for the first frame
+        """
+        step = self.__SUBSAMPLE_STEP
+        previous_hist = self.__previous_hist
+        hist_diff, self.__previous_hist = calculate_histogram_difference(
+            current_frame, self.__empty_hist if previous_hist is None else previous_hist, step)
+
+        if previous_hist is None:
+            return None
+
+        return float(hist_diff) * step * step
+
+    def __is_max_recording_length_exceeded(self, now):
+        return self.__max_recording_length_seconds > 0 and self.__recording_started_at is not None and (
+                now - self.__recording_started_at >= self.__max_recording_length_seconds)
+
+    def __is_max_time_since_last_motion_detection_exceeded(self, now):
+        return self.__encoding and self.__time_of_last_motion_detection is not None and (
+                now - self.__time_of_last_motion_detection > self.__MAX_TIME_SINCE_LAST_MOTION_DETECTION_SECONDS)
 
     def __start_recording(self):
         self.__encoder.output.fileoutput = self.__get_recording_file_path()
@@ -242,7 +513,7 @@ class MotionDetector:
         self.__write_snapshot_to_file()
         file_path = self.__get_recording_file_path()
         snapshot_path = self.__get_snapshot_file_path()
-        self.log_info(f"Writing file: {file_path}")
+        self.log_info("Writing file: %s", file_path)
         self.__encoder.output.stop()
         _, file_name = os.path.split(file_path)
         if self.__snapshot_only:
@@ -251,6 +522,7 @@ class MotionDetector:
             self.__upload_file(file_path=file_path)
         self.__encoding = False
         self.__start_time_of_last_recording = None
+        self.__recording_started_at = None
 
     def __create_snapshot(self):
         request = self.__picam2.capture_request()
@@ -259,7 +531,7 @@ class MotionDetector:
 
     def __write_snapshot_to_file(self):
         file_path = self.__get_snapshot_file_path()
-        self.log_info(f"Writing snapshot file: {file_path}")
+        self.log_info("Writing snapshot file: %s", file_path)
         self.__create_snapshot()
 
     def __get_recording_file_path(self):
@@ -280,6 +552,7 @@ class MotionDetector:
             main={"size": (self.__width, self.__height), "format": "RGB888"},
             lores={"size": self.__lsize, "format": "YUV420"})
         self.__picam2.configure(video_config)
+        self.__lores_stride = self.__picam2.stream_configuration("lores")["stride"]
 
         ctrls = Controls(self.__picam2)
     #    ctrls.AnalogueGain = self.__gain
@@ -300,11 +573,10 @@ class MotionDetector:
         """
         Sets the zoom factor of the camera.
         """
-        size = self.__picam2.capture_metadata()['ScalerCrop'][2:]
-        self.__picam2.capture_metadata()
-        size = [int(s * self.__zoom_factor) for s in size]
-        offset = [(r - s) // 2 for r, s in zip(self.__picam2.sensor_resolution, size)]
-        self.__picam2.set_controls({"ScalerCrop": offset + size})
+        width, height = self.__picam2.capture_metadata()['ScalerCrop'][2:]
+        width, height = int(width * self.__zoom_factor), int(height * self.__zoom_factor)
+        sensor_width, sensor_height = self.__picam2.sensor_resolution
+        self.__picam2.set_controls({"ScalerCrop": ((sensor_width - width) // 2, (sensor_height - height) // 2, width, height)})
 
     def __delete_recording(self, file_path):
         """
@@ -312,7 +584,7 @@ class MotionDetector:
         :param file_path: file to delete
         """
         if self.__delete_local_recordings:
-            self.log_info(f"Deleting local file: {file_path}")
+            self.log_info("Deleting local file: %s", file_path)
             os.remove(file_path)
 
     def __send_email(self, file_path):
@@ -321,32 +593,86 @@ class MotionDetector:
         :param file_path: Path of the recording to send
         """
         try:
-            msg = MIMEMultipart()
-            msg['From'] = self.__email_username
-            msg['To'] = self.__recipient
-            msg['Subject'] = f"Motion detected at {datetime.datetime.now()}"
-
-            with open(file_path, 'rb') as attachment_file:
-                attachment = MIMEBase('application', 'octet-stream')
-                attachment.set_payload(attachment_file.read())
-                encoders.encode_base64(attachment)
-                attachment.add_header('Content-Disposition', f'attachment; filename={os.path.basename(file_path)}')
-                msg.attach(attachment)
-
             with smtplib.SMTP_SSL(self.__smtp_server, self.__smtp_port, timeout=10) as server:
                 server.login(self.__email_username, self.__email_password)
-                server.sendmail(self.__email_username, self.__recipient, msg.as_string())
-                self.log_info(f"Sent email with attachment {file_path}")
+                self.__send_attachment(server, file_path)
+                self.log_info("Sent email with attachment %s", file_path)
         except (smtplib.SMTPException, socket.timeout) as e:
-            self.log_error(f"Failed to send email with attachment {file_path}: {e}")
+            self.log_error("Failed to send email with attachment %s: %s", file_path, e)
+
+    def __send_attachment(self, server, file_path):
+        """
+        Streams a MIME message with the file attached to the server.
+
+        The attachment is read and base64 encoded chunk by chunk, so recordings are never held in memory as a whole.
+        :param server: logged in SMTP connection
+        :param file_path: Path of the file to attach
+        """
+        boundary = f"=============={uuid.uuid4().hex}=="
+        headers = (
+            f"From: {self.__email_username}\r\n"
+            f"To: {self.__recipient}\r\n"
+            f"Subject: Motion detected at {datetime.datetime.now()}\r\n"
+            "MIME-Version: 1.0\r\n"
+            f"Content-Type: multipart/mixed; boundary=\"{boundary}\"\r\n"
+            "\r\n"
+            f"--{boundary}\r\n"
+            "Content-Type: application/octet-stream\r\n"
+            "Content-Transfer-Encoding: base64\r\n"
+            f"Content-Disposition: attachment; filename={os.path.basename(file_path)}\r\n"
+            "\r\n"
+        )
+
+        with open(file_path, 'rb') as attachment_file:
+            code, response = server.mail(self.__email_username)
+            if code != 250:
+                server.rset()
+                raise smtplib.SMTPSenderRefused(code, response, self.__email_username)
+            code, response = server.rcpt(self.__recipient)
+            if code not in (250, 251):
+                server.rset()
+                raise smtplib.SMTPRecipientsRefused({self.__recipient: (code, response)})
+            code, response = server.docmd("DATA")
+            if code != 354:
+                server.rset()
+                raise smtplib.SMTPDataError(code, response)
+
+            try:
+                server.send(headers.encode())
+                # 57 input bytes make one 76 character base64 line
+                while chunk := attachment_file.read(57 * 1024):
+                    server.send(base64.encodebytes(chunk).replace(b"\n", b"\r\n"))
+                server.send(f"--{boundary}--\r\n.\r\n".encode())
+            except BaseException:
+                # the server is still reading the message, drop the connection so nothing else ends up in it
+                server.close()
+                raise
+
+        code, response = server.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, response)
 
     def __upload_file(self, file_path):
         """
-        Sends the recording via email and deletes it.
+        Sends the recording via email in the background and deletes it afterwards.
         :param file_path:
         """
         if self.__email_username and self.__recipient and self.__email_password:
-            self.__send_email(file_path)
+            future = self.__uploader.submit(self.__send_email, file_path)
+            future.add_done_callback(lambda f: self.__finish_upload(f, file_path))
+        else:
+            self.__delete_recording(file_path)
+
+    def __finish_upload(self, future, file_path):
+        """
+        Deletes the recording once the email has been sent.
+        :param future: future of the email send
+        :param file_path: file that was sent
+        """
+        error = future.exception()
+        if error is not None:
+            self.log_error("An error occurred while uploading %s: %s", file_path, error)
+            return
         self.__delete_recording(file_path)
 
     def stop(self):
@@ -354,61 +680,59 @@ class MotionDetector:
         Stops the encoder and exits the application.
         """
         self.__picam2.stop_encoder()
+        self.__uploader.shutdown(wait=True)
         sys.exit(1)
 
-    def log_debug(self, message):
-        logging.debug(f"{Fore.LIGHTBLUE_EX} {message} {Style.RESET_ALL}")
+    def log_debug(self, message, *args):
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug(self.__DEBUG_PREFIX + message + self.__LOG_SUFFIX, *args)
 
-    def log_info(self, message):
-        logging.info(f"{Fore.LIGHTYELLOW_EX} {message} {Style.RESET_ALL}")
+    def log_info(self, message, *args):
+        if logging.root.isEnabledFor(logging.INFO):
+            logging.info(self.__INFO_PREFIX + message + self.__LOG_SUFFIX, *args)
 
-    def log_warning(self, message):
-        logging.warning(f"{Fore.YELLOW} {message} {Style.RESET_ALL}")
+    def log_warning(self, message, *args):
+        if logging.root.isEnabledFor(logging.WARNING):
+            logging.warning(self.__WARNING_PREFIX + message + self.__LOG_SUFFIX, *args)
 
-    def log_error(self, message):
-        logging.error(f"{Fore.RED} {message} {Style.RESET_ALL}")
+    def log_error(self, message, *args):
+        if logging.root.isEnabledFor(logging.ERROR):
+            logging.error(self.__ERROR_PREFIX + message + self.__LOG_SUFFIX, *args)
 
-    def log_stats(self, message):
-        logging.info(f"{Fore.LIGHTBLUE_EX} {message} {Style.RESET_ALL}")
+    def log_stats(self, message, *args):
+        if logging.root.isEnabledFor(logging.INFO):
+            logging.info(self.__STATS_PREFIX + message + self.__LOG_SUFFIX, *args)
 
-    def log_events(self, message):
-        logging.info(f"{Fore.LIGHTCYAN_EX} {message} {Style.RESET_ALL}")
+    def log_events(self, message, *args):
+        if logging.root.isEnabledFor(logging.INFO):
+            logging.info(self.__EVENTS_PREFIX + message + self.__LOG_SUFFIX, *args)
 
-    def log_movement_start(self, message):
-        logging.info(f"{Back.RED} {message} {Style.RESET_ALL}")
-    def log_movement_end(self, message):
-        logging.info(f"{Back.GREEN}{Fore.BLACK} {message} {Style.RESET_ALL}")
+    def log_movement_start(self, message, *args):
+        if logging.root.isEnabledFor(logging.INFO):
+            logging.info(self.__MOVEMENT_START_PREFIX + message + self.__LOG_SUFFIX, *args)
 
-    def stats_at_interval(self, message):
-        if self.__tick == self.__display_interval:
-                self.log_stats(message)
-                self.__tick = 0
-        else:
-            self.__tick += 1
+    def log_movement_end(self, message, *args):
+        if logging.root.isEnabledFor(logging.INFO):
+            logging.info(self.__MOVEMENT_END_PREFIX + message + self.__LOG_SUFFIX, *args)
 
-    def events_at_interval(self, message):
+    def events_at_interval(self, message, *args):
         if self.__events_tick == self.__events_interval:
-                self.log_events(message)
+                self.log_events(message, *args)
                 self.__events_tick = 0
         else:
             self.__events_tick += 1
 
     def display_diff_stats(self, diff):
-        diff_sum = 0
-        diff_last = 0
-        self.__diff_min = 9999
-        self.__diff_max = 0
-        for value in self.__diff_history:
-            if value < self.__diff_min:
-                self.__diff_min = value
-            if value > self.__diff_max:
-                self.__diff_max = value
-            diff_sum += value
-            diff_last = value
-
-        iterations = len(self.__diff_history)
-        self.__diff_average = diff_sum / len(self.__diff_history)
-        self.stats_at_interval(f"Diff Stats ({iterations} iterations): NEWEST: {diff} | OLDEST: {diff_last} | AVG: {self.__diff_average} | MIN: {self.__diff_min} | MAX: {self.__diff_max}")
+        iterations = min(self.__diff_index, self.__diff_history_count)
+        history = self.__diff_history[:iterations]
+        # once the ring is full the oldest value is the next one to be overwritten
+        diff_last = self.__diff_history[self.__diff_index % self.__diff_history_count
+                                         if self.__diff_index >= self.__diff_history_count else 0]
+        self.__diff_min = history.min()
+        self.__diff_max = history.max()
+        self.__diff_average = history.mean()
+        self.log_stats("Diff Stats (%s iterations): NEWEST: %s | OLDEST: %s | AVG: %s | MIN: %s | MAX: %s",
+                       iterations, diff, diff_last, self.__diff_average, self.__diff_min, self.__diff_max)
 
     def display_motion_events(self):
 
@@ -423,13 +747,17 @@ class MotionDetector:
                 events_last_hour += 1
             if event > (time.time() - 24 * 60 * 60):
                 events_last_day += 1
-        self.events_at_interval(f"Event Stats - (10 Min / 1 Hour / 1 Day) : {events_last_10_min} | {events_last_hour} | {events_last_day}")
+        self.events_at_interval("Event Stats - (10 Min / 1 Hour / 1 Day) : %s | %s | %s",
+                                events_last_10_min, events_last_hour, events_last_day)
 
     def store_diff_history(self, diff):
-        if len(self.__diff_history) >= self.__diff_history_count:
-            self.__diff_history.pop()
-        self.__diff_history.appendleft(diff)
-        self.display_diff_stats(diff)
+        self.__diff_history[self.__diff_index % self.__diff_history_count] = diff
+        self.__diff_index += 1
+        if self.__tick == self.__display_interval:
+            self.display_diff_stats(diff)
+            self.__tick = 0
+        else:
+            self.__tick += 1
         self.display_motion_events()
 
 
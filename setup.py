@@ -0,0 +1,18 @@
+"""Builds the optional compiled motion detection kernel: python3 setup.py build_ext --inplace"""
+import platform
+
+from Cython.Build import cythonize
+from setuptools import Extension, setup
+
+if platform.machine() in ('aarch64', 'armv7l'):
+    cpu_flags = ['-mcpu=native']
+else:
+    cpu_flags = ['-march=native']
+
+setup(
+    name='motion_detector_kernel',
+    ext_modules=cythonize([
+        Extension('_motion_kernel', ['_motion_kernel.pyx'],
+                  extra_compile_args=['-O3', '-ftree-vectorize'] + cpu_flags),
+    ]),
+)